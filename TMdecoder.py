@@ -6,10 +6,19 @@ import sys
 import argparse
 import numpy as np
 import glob as glob
+import hashlib
+import os
+import tempfile
+import functools
+import numpy.lib.recfunctions as rfn
 from datetime import datetime
 from datetime import timezone
 from sys import exit
 
+# Bump this whenever a change to the decoding would alter the decoded values,
+# so that stale cache entries are not reused.
+DECODER_VERSION = '4'
+
 def RS41_RH_wvmr(TC_ambient,hPa_ambient,rh_reported,TC_humSensor):
     '''
     Parameters: ambient:tempC,prshPa, RH_reported, tempC_of humSensor
@@ -52,8 +61,418 @@ def Hardy_1998(TC):
    esw_hPa=np.exp(lesw)/100
    return esw_hPa
 
+# Binary record layouts, by name. Each layout describes one record of the
+# binary payload, which follows header_len bytes of message header and is
+# followed by trailer_len bytes that are not decoded.
+# The fields are listed in storage order as (name, numpy type, scale, offset),
+# and decode to raw/scale + offset. A field type may be a (type, shape) tuple,
+# for an array of raw values that are not converted.
+# The layout for a message is the one for its instrument with the latest
+# valid_from (unix time) that is not after the message time stamp.
+LAYOUTS = {
+    # struct RS41Sample_t {
+    #    uint8_t valid;
+    #    uint32_t frame;
+    #    uint16_t tdry; (tdry+100)*100
+    #    uint16_t humidity; (humdity*100)
+    #    uint16_t humidity sensor temp; (temp+100)*100
+    #    uint16_t pres; (pres*50)
+    #    uint16_t error;
+    #};
+    'rs41': {
+        'instrument': 'rs41',
+        'valid_from': 0,
+        'header_len': 6,
+        'trailer_len': 0,
+        'fields': [
+            ('valid', 'u1', 1, 0),
+            ('secs_from_start', '>i4', 1, 0),
+            ('air_temp_degC', '>u2', 100.0, -100.0),
+            ('humdity_percent', '>u2', 100.0, 0.0),
+            ('humidity_sensor_temp_degC', '>u2', 100.0, -100.0),
+            ('pres_mb', '>u2', 50.0, 0.0),
+            ('module_error', '>u2', 1, 0),
+        ],
+    },
+    # LPC HK scheme used for the 2021 campaign (readLPCXML_2021.py)
+    'lpc_2021': {
+        'instrument': 'lpc',
+        'valid_from': 0,
+        'header_len': 132,
+        # The last 96 byte record of the payload is not decoded
+        'trailer_len': 96,
+        'fields': [
+            ('HGBins', ('>u2', 16), 1, 0),
+            ('LGBins', ('>u2', 16), 1, 0),
+            ('Time', '>u2', 1, 0),
+            ('Pump1_I', '>u2', 1, 0),
+            ('Pump2_I', '>u2', 1, 0),
+            ('PHA_I', '>u2', 1, 0),
+            ('PHA_12V', '>u2', 1000.0, 0.0),
+            ('PHA_3V3', '>u2', 1000.0, 0.0),
+            ('Input_V', '>u2', 1000.0, 0.0),
+            ('Flow', '>u2', 1000.0, 0.0),
+            ('CPU_V', '>u2', 1000.0, 0.0),
+            ('Pump1_PWM', '>u2', 1, 0),
+            ('Pump2_PWM', '>u2', 1, 0),
+            ('Pump1_T', '>u2', 100.0, -273.15),
+            ('Pump2_T', '>u2', 100.0, -273.15),
+            ('Laser_T', '>u2', 100.0, -273.15),
+            ('PCB_T', '>u2', 100.0, -273.15),
+            ('Inlet_T', '>u2', 100.0, -273.15),
+        ],
+    },
+    # Current LPC HK scheme, in use from 2023
+    'lpc_2023': {
+        'instrument': 'lpc',
+        'valid_from': 1672531200,
+        'header_len': 132,
+        # The last 96 byte record of the payload is not decoded
+        'trailer_len': 96,
+        'fields': [
+            ('HGBins', ('>u2', 16), 1, 0),
+            ('LGBins', ('>u2', 16), 1, 0),
+            ('Time', '>u2', 1, 0),
+            ('Pump1_I', '>u2', 1, 0),
+            ('Pump2_I', '>u2', 1, 0),
+            ('PHA_I', '>u2', 1, 0),
+            ('PHA_12V', '>u2', 1000.0, 0.0),
+            ('PHA_3V3', '>u2', 1000.0, 0.0),
+            ('CPU_V', '>u2', 1000.0, 0.0),
+            ('Input_V', '>u2', 1000.0, 0.0),
+            ('Flow', '>u2', 1000.0, 0.0),
+            ('Pump1_PWM', '>u2', 1, 0),
+            ('Pump2_PWM', '>u2', 1, 0),
+            ('Pump1_T', '>u2', 100.0, -273.15),
+            ('Pump2_T', '>u2', 100.0, -273.15),
+            ('Laser_T', '>u2', 100.0, -273.15),
+            ('PCB_T', '>u2', 100.0, -273.15),
+            ('Inlet_T', '>u2', 100.0, -273.15),
+        ],
+    },
+}
+
+# The LPC HK channels, in the row order of LPCmsg.HKData
+LPC_HK_NAMES = ['Time', 'Pump1_I', 'Pump2_I', 'PHA_I', 'PHA_12V', 'PHA_3V3', 'CPU_V', 'Input_V', 'Flow',
+                'Pump1_PWM', 'Pump2_PWM', 'Pump1_T', 'Pump2_T', 'Laser_T', 'PCB_T', 'Inlet_T']
+# The units of the LPC HK channels, as shown in the CSV header
+LPC_HK_UNITS = ['[unix_time]', '[mA]', '[mA]', '[mA]', '[V]', '[V]', '[V]', '[V]', '[SLPM]',
+                '[#]', '[#]', '[C]', '[C]', '[C]', '[C]', '[C]']
+
+# Unique labels of the LPC bins: high gain then low gain, in LPCmsg.bins column order.
+# The diameters in LPCmsg.bin_header are not unique.
+LPC_BIN_LABELS = [f'HG{i:02d}' for i in range(16)] + [f'LG{i:02d}' for i in range(16)]
+
+def selectLayout(instrument:str, unix_time:int)->str:
+    '''
+    Select the record layout for a message.
+
+    Args:
+        instrument: 'rs41' or 'lpc'.
+        unix_time: The message time stamp.
+
+    Returns:
+        str: The name of the layout in LAYOUTS.
+
+    Raises:
+        KeyError: If there is no layout for the instrument at that time.
+    '''
+    candidates = [(layout['valid_from'], name) for name, layout in LAYOUTS.items()
+                  if layout['instrument'] == instrument and layout['valid_from'] <= unix_time]
+    if not candidates:
+        raise KeyError(f'No {instrument} record layout for time {unix_time}')
+    return max(candidates)[1]
+
+@functools.lru_cache(maxsize=None)
+def compileLayout(name:str)->np.dtype:
+    '''
+    Build the NumPy structured dtype for one record of a layout.
+
+    Args:
+        name: The name of the layout in LAYOUTS.
+
+    Returns:
+        np.dtype: The packed record dtype.
+    '''
+    return np.dtype([(f[0], f[1]) for f in LAYOUTS[name]['fields']])
+
+@functools.lru_cache(maxsize=None)
+def conversionVectors(name:str, fields:tuple)->tuple:
+    '''
+    Gather the scale and offset of some fields of a layout.
+
+    Args:
+        name: The name of the layout in LAYOUTS.
+        fields: The field names.
+
+    Returns:
+        tuple: The scale and offset arrays, in the order of fields.
+    '''
+    conv = {f[0]: f[2:] for f in LAYOUTS[name]['fields']}
+    scale = np.array([conv[f][0] for f in fields], dtype=float)
+    offset = np.array([conv[f][1] for f in fields], dtype=float)
+    return scale, offset
+
+def recordCount(bindata:bytes, name:str)->int:
+    '''
+    Count the complete records in a binary payload.
+
+    Args:
+        bindata: The binary payload.
+        name: The name of the layout in LAYOUTS.
+
+    Returns:
+        int: The number of records between the header and the trailer.
+    '''
+    layout = LAYOUTS[name]
+    data_len = len(bindata) - layout['header_len'] - layout['trailer_len']
+    return max(data_len // compileLayout(name).itemsize, 0)
+
+def decodeRecords(bindata:bytes, name:str)->np.ndarray:
+    '''
+    View the binary records of a message as a structured array, without copying.
+
+    Args:
+        bindata: The binary payload.
+        name: The name of the layout in LAYOUTS.
+
+    Returns:
+        np.ndarray: The raw records.
+    '''
+    count = recordCount(bindata, name)
+    return np.frombuffer(bindata, dtype=compileLayout(name), count=count, offset=LAYOUTS[name]['header_len'])
+
+def convertFields(records:np.ndarray, name:str, fields:list)->np.ndarray:
+    '''
+    Convert fields of raw records to real-world values.
+
+    Args:
+        records: The raw records, as returned by decodeRecords().
+        name: The name of the layout in LAYOUTS.
+        fields: The field names.
+
+    Returns:
+        np.ndarray: A (len(records), len(fields)) array of values.
+    '''
+    scale, offset = conversionVectors(name, tuple(fields))
+    raw = rfn.structured_to_unstructured(records[fields], dtype=float)
+    return raw / scale + offset
+
+def npyHeader(dtype:np.dtype, count:int)->bytes:
+    '''
+    Return the .npy version 1.0 header of a 1-D array, after the magic string and length.
+
+    Args:
+        dtype: The array dtype.
+        count: The array length.
+
+    Returns:
+        bytes: The header, as written by np.save.
+    '''
+    f = io.BytesIO()
+    d = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (count,)}
+    np.lib.format.write_array_header_1_0(f, d)
+    return f.getvalue()[10:]
+
+class TMcache:
+    # Eviction removes entries until the cache is below this fraction of max_bytes,
+    # so that the cache directory is not scanned on every store
+    low_water = 0.9
+
+    def __init__(self, cache_dir:str, max_bytes:int=1024*1024*1024):
+        '''
+        On-disk cache of decoded TM arrays.
+
+        Entries are keyed by a hash of the TM file bytes plus DECODER_VERSION,
+        the message type and the record layout.
+        Each entry is a single .npy file holding a structured array, with one
+        row per record, so that it can be loaded with one memory map. When the
+        total size of the cache exceeds max_bytes, the least recently used
+        entries are removed.
+
+        Args:
+            cache_dir: The cache directory. It is created if necessary.
+            max_bytes: The maximum total size of the cache, in bytes.
+
+        Examples:
+            cache = TMcache('~/.tmdecoder_cache')
+            msg = LPCmsg('TM.LPC.ready_tm', cache=cache)
+        '''
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        # Running estimate of the cache size, set by the first scan
+        self.total_bytes = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, data:bytes, msg_type:str, layout:str='')->str:
+        '''
+        Compute the cache key for a TM message.
+
+        Args:
+            data: The complete TM message bytes.
+            msg_type: The message type the data is decoded as, 'rs41' or 'lpc'.
+            layout: The record layout used to decode the message.
+
+        Returns:
+            str: The hex digest identifying the decoded arrays.
+        '''
+        h = hashlib.sha256(data)
+        for part in (DECODER_VERSION, msg_type, layout):
+            h.update(b'\0' + part.encode())
+        return h.hexdigest()
+
+    def entryPath(self, key:str)->str:
+        '''
+        Return the file name of the entry for a key.
+        '''
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def load(self, key:str, dtype:np.dtype)->np.ndarray:
+        '''
+        Load the array stored under a key.
+
+        An entry whose data is bad, or is not of the expected dtype, is
+        removed so that it can be written again.
+
+        Args:
+            key: The cache key.
+            dtype: The structured dtype of the entry.
+
+        Returns:
+            np.ndarray: The memory-mapped array, or None if the key is not in
+            the cache. It is mapped copy-on-write, so like a freshly decoded
+            array it can be modified, without changing the cache file.
+        '''
+        path = self.entryPath(key)
+        try:
+            a = self.mapEntry(path, dtype)
+        except FileNotFoundError:
+            return None
+        except (ValueError, EOFError):
+            # Truncated file or bad header
+            self.remove(path)
+            return None
+        except OSError:
+            # Out of memory or file handles; the entry may be good
+            return None
+        if a.dtype != dtype or a.ndim != 1:
+            self.remove(path)
+            return None
+
+        # Record the access for LRU eviction, if the cache is writable
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return a
+
+    def mapEntry(self, path:str, dtype:np.dtype)->np.ndarray:
+        '''
+        Memory-map an entry file.
+
+        The .npy header is compared with the one np.save writes for dtype,
+        which is much faster than parsing it. Any other header is left to np.load.
+
+        Args:
+            path: The entry file name.
+            dtype: The structured dtype of the entry.
+
+        Returns:
+            np.ndarray: The copy-on-write memory-mapped array.
+
+        Raises:
+            OSError, ValueError, EOFError: If the file cannot be read.
+        '''
+        with open(path, 'rb') as f:
+            prefix = f.read(10)
+            if prefix[:8] == b'\x93NUMPY\x01\x00':
+                offset = 10 + int.from_bytes(prefix[8:10], 'little')
+                header = f.read(offset - 10)
+                count = (os.fstat(f.fileno()).st_size - offset) // dtype.itemsize
+                if header == npyHeader(dtype, count):
+                    return np.memmap(path, dtype=dtype, mode='c', offset=offset, shape=(count,))
+        return np.load(path, mmap_mode='c')
+
+    def store(self, key:str, a:np.ndarray)->None:
+        '''
+        Save an array under a key, then evict old entries if the cache is too large.
+
+        The entry is written to a temporary file and renamed into place,
+        replacing any bad entry, so a concurrent reader never sees a partial entry.
+
+        Args:
+            key: The cache key.
+            a: The structured array to save.
+
+        Returns:
+            None
+        '''
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp', suffix='.npy')
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, a)
+                size = f.tell()
+            os.replace(tmp_path, self.entryPath(key))
+        except OSError:
+            self.remove(tmp_path)
+            return
+
+        if self.total_bytes is None:
+            self.total_bytes = sum(size for _, size, _ in self.entries())
+        else:
+            self.total_bytes += size
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def entries(self)->list:
+        '''
+        List the cache entries.
+
+        Returns:
+            list: (access time, size, path) for each entry.
+        '''
+        entries = []
+        for e in os.scandir(self.cache_dir):
+            if e.name.startswith('.') or not e.name.endswith('.npy'):
+                continue
+            try:
+                st = e.stat()
+            except OSError:
+                # Removed by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, e.path))
+        return entries
+
+    def evict(self)->None:
+        '''
+        Remove least recently used entries until the cache is below low_water * max_bytes.
+
+        Returns:
+            None
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.low_water * self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+        self.total_bytes = total
+
+    def remove(self, path:str)->None:
+        '''
+        Delete a cache file, ignoring errors.
+        '''
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
 class TMmsg:
-    def __init__(self, msg_filename:str):
+    def __init__(self, msg_filename:str, cache:TMcache=None):
         '''
         Base class for Strateole2 TM message decoding
 
@@ -62,7 +481,8 @@ class TMmsg:
         STR2-ZEPH-DCI-0-031 Version : 1.3
 
         Args:
-            data (bytes): The binary data to decode.
+            msg_filename: The message file name.
+            cache: Optional TMcache used to skip decoding of previously seen messages.
 
         Examples:
             tm_msg = TMmsg(data)
@@ -73,6 +493,8 @@ class TMmsg:
             data = binary_file.read()
 
         self.data = data
+        self.cache = cache
+        self.tm_xml = self.parse_TM_xml()
         self.bindata = self.binaryData()        
         self.unix_end_time = self.timeStamp()
         date_time = datetime.fromtimestamp(int(self.unix_end_time),tz=timezone.utc)
@@ -128,8 +550,7 @@ class TMmsg:
         Raises:
             KeyError: If the 'TM' or 'Length' keys are not found in the parsed XML data.
         '''
-        tm_xml = self.parse_TM_xml()
-        bin_length = int(tm_xml['TM']['Length'])
+        bin_length = int(self.tm_xml['TM']['Length'])
         bin_start = self.data.find(b'</CRC>\nSTART') + 12
         return self.data[bin_start:bin_start+bin_length]
 
@@ -151,27 +572,110 @@ class RS41msg(TMmsg):
     # The payload is coded as follows:
     # uint32_t start time
     # uint16_t n_samples
-    # data records:
-    # struct RS41Sample_t {
-    #    uint8_t valid;
-    #    uint32_t frame;
-    #    uint16_t tdry; (tdry+100)*100
-    #    uint16_t humidity; (humdity*100)
-    #    uint16_t pres; (pres*100)
-    #    uint16_t error;
-    #};
-    def __init__(self, msg_filename:str):
+    # data records, see LAYOUTS['rs41']
+
+    # Decoded fields, one row per sample, as stored in the cache
+    dtype = np.dtype([('valid', int), ('secs_from_start', int), ('unix_time', int),
+                      ('air_temp_degC', float), ('humdity_percent', float),
+                      ('humidity_sensor_temp_degC', float), ('pres_mb', float), ('module_error', int),
+                      ('rs41_rh_percent', float), ('wv_mixing_ratio_ppmv', float)])
+    fields = list(dtype.names)
+
+    def __init__(self, msg_filename:str, cache:TMcache=None, layout:str=None):
         '''
         Initialize the object with the provided binary data.
 
         Args:
             msg_filename: The message file name.
+            cache: Optional TMcache holding previously decoded columns.
+            layout: The record layout name in LAYOUTS. Selected from the
+                message time stamp if not given.
 
         Returns:
             None
         '''
-        super().__init__(msg_filename)
-        self.records = self.allRS41samples()
+        super().__init__(msg_filename, cache)
+        self.layout = layout or selectLayout('rs41', self.unix_end_time)
+
+        table = None
+        if self.cache:
+            key = self.cache.key(self.data, 'rs41', self.layout)
+            table = self.cache.load(key, self.dtype)
+        if table is None:
+            table = self.decodeTable()
+            if self.cache:
+                self.cache.store(key, table)
+        self.table = table
+        # The columns are views of the table
+        self.columns = {f: table[f] for f in self.fields}
+        self._records = None
+
+    @property
+    def records(self)->list:
+        '''
+        The decoded samples as a list of dictionaries, built on first use.
+        '''
+        if self._records is None:
+            self._records = self.columnsToRecords(self.columns)
+        return self._records
+
+    def exportArrays(self)->dict:
+        '''
+        Return the decoded arrays, one row per sample.
+
+        Returns:
+            dict: The decoded columns, keyed by field name.
+        '''
+        return self.columns
+
+    def to_dataframe(self, arrays:dict=None):
+        '''
+        Build a pandas DataFrame on the decoded columns, without copying them.
+
+        Args:
+            arrays: Arrays as returned by exportArrays(). Defaults to those of this message.
+
+        Returns:
+            pandas.DataFrame: One column per field, indexed by unix_time.
+        '''
+        import pandas as pd
+
+        if arrays is None:
+            arrays = self.exportArrays()
+        index = pd.Index(arrays['unix_time'], name='unix_time', copy=False)
+        return pd.DataFrame({f: arrays[f] for f in self.fields if f != 'unix_time'}, index=index, copy=False)
+
+    def to_xarray(self, arrays:dict=None):
+        '''
+        Build an xarray Dataset on the decoded columns, without copying them.
+
+        xarray makes its own copy of the unix_time coordinate for the index.
+
+        Args:
+            arrays: Arrays as returned by exportArrays(). Defaults to those of this message.
+
+        Returns:
+            xarray.Dataset: One variable per field, along the unix_time dimension.
+        '''
+        import xarray as xr
+
+        if arrays is None:
+            arrays = self.exportArrays()
+        data_vars = {f: ('unix_time', arrays[f]) for f in self.fields if f != 'unix_time'}
+        return xr.Dataset(data_vars, coords={'unix_time': arrays['unix_time']})
+
+    def columnsToRecords(self, columns:dict)->list:
+        '''
+        Convert per-field arrays, as returned by decodeColumns(), to records.
+
+        Args:
+            columns: Arrays of decoded values, keyed by field name.
+
+        Returns:
+            list: List of dictionaries containing decoded values for each data sample.
+        '''
+        values = [columns[f].tolist() for f in self.fields]
+        return [dict(zip(self.fields, v)) for v in zip(*values)]
 
     def csvText(self)->list:
         '''
@@ -223,61 +727,69 @@ class RS41msg(TMmsg):
                 out_file.write(r)
                 out_file.write('\n')
 
-    def decodeRS41sample(self, record)->dict:
+    def decodeColumns(self)->dict:
         '''
-        Decode a binary sample and convert it to real-world values.
-
-        Args:
-            record: The binary sample to decode.
+        Decode all data samples and convert them to real-world values.
 
         Returns:
-            dict: Decoded real-world values of the binary sample.
-        '''
-        r = {}
-        r['valid'] = struct.unpack_from('B', record, 0)[0]
-        r['secs_from_start'] = struct.unpack_from('>l', record, 1)[0]
-        # print('decodeRS41',self.unix_end_time,r['unix_time'])
-        r['air_temp_degC'] = struct.unpack_from('>H', record, 5)[0]/100.0-100.0
-        r['humdity_percent'] = struct.unpack_from('>H', record, 7)[0]/100.0
-        r['humidity_sensor_temp_degC'] = struct.unpack_from('>H', record, 9)[0]/100.0-100.0
-        r['pres_mb'] = struct.unpack_from('>H', record, 11)[0]/50.0
-        r['module_error'] = struct.unpack_from('>H', record, 13)[0]
-        r['rs41_rh_percent'],r['wv_mixing_ratio_ppmv']=RS41_RH_wvmr(r['air_temp_degC'],r['pres_mb'],r['humdity_percent'],r['humidity_sensor_temp_degC'])
-        #print(r)
-        return r
-    
-    def allRS41samples(self)->list:
-        '''
-        Go through all data samples and convert them to real-world values.
+            dict: One array per decoded field, keyed by field name.
 
-        Returns:
-            list: List of dictionaries containing decoded real-world values for each data sample.
+        Raises:
+            IndexError: If there are no samples.
         '''
-        record_len = 1 + 4 + 2 + 2 + 2 + 2 + 2
-        records = []
-        for i in range(6, len(self.bindata)-6, record_len):
-            record = self.bindata[i:i+record_len]
-            records.append(self.decodeRS41sample(record))
+        samples = decodeRecords(self.bindata, self.layout)
+
+        columns = {}
+        for f in LAYOUTS[self.layout]['fields']:
+            name = f[0]
+            if f[2:] == (1, 0):
+                columns[name] = samples[name].astype(int)
+            else:
+                columns[name] = convertFields(samples, self.layout, [name])[:, 0]
+
+        columns['rs41_rh_percent'], columns['wv_mixing_ratio_ppmv'] = RS41_RH_wvmr(
+            columns['air_temp_degC'], columns['pres_mb'], columns['humdity_percent'],
+            columns['humidity_sensor_temp_degC'])
 
         # Compute the unix time for each sample
-        start_time = self.unix_end_time - (records[-1]['secs_from_start'] - records[0]['secs_from_start'] + 1)
-        for i in range(len(records)):
-            records[i]['unix_time'] =  records[i]['secs_from_start'] + start_time
+        secs = columns['secs_from_start']
+        start_time = self.unix_end_time - (secs[-1] - secs[0] + 1)
+        columns['unix_time'] = secs + start_time
 
-        return records
+        return {f: columns[f] for f in self.fields}
+
+    def decodeTable(self)->np.ndarray:
+        '''
+        Decode all data samples into one structured array.
+
+        Returns:
+            np.ndarray: One row of dtype per sample.
+        '''
+        columns = self.decodeColumns()
+        table = np.empty(len(columns['valid']), dtype=self.dtype)
+        for f in self.fields:
+            table[f] = columns[f]
+        return table
 
 class LPCmsg(TMmsg):
-    def __init__(self, msg_filename:str):
+    # Decoded arrays, one row per record, as stored in the cache
+    dtype = np.dtype([('hk', float, (16,)), ('bins', float, (32,))])
+
+    def __init__(self, msg_filename:str, cache:TMcache=None, layout:str=None):
         '''
         Initialize the object with the provided binary data.
 
         Args:
             msg_filename: The message file name.
+            cache: Optional TMcache holding previously decoded arrays.
+            layout: The record layout name in LAYOUTS. Selected from the
+                message time stamp if not given.
 
         Returns:
             None
         '''
-        super().__init__(msg_filename)
+        super().__init__(msg_filename, cache)
+        self.layout = layout or selectLayout('lpc', self.unix_end_time)
 
         #LPC bins - each number is the left end of the bins in nm.   The first bin has minimal sensitivity
         diams = [275,300,325,350,375,400,450,500,550,600,650,700,750,800,900,1000,1200,1400,1600,1800,2000,2500,3000,3500,4000,6000,8000,10000,13000,16000,24000,24000]
@@ -289,7 +801,7 @@ class LPCmsg(TMmsg):
         self.lon= ''
         self.alt = ''
 
-        tm_xml = self.parse_TM_xml()
+        tm_xml = self.tm_xml
 
         self.instrument = 'Unknown'
         if 'Inst' in tm_xml['TM']:
@@ -301,43 +813,115 @@ class LPCmsg(TMmsg):
                 self.lat = tokens[0]
                 self.lon = tokens[1]
                 self.alt = tokens[2]
-        self.unpackBinary()
+
+        table = None
+        if self.cache:
+            key = self.cache.key(self.data, 'lpc', self.layout)
+            table = self.cache.load(key, self.dtype)
+        if table is not None:
+            self.setTable(table)
+        else:
+            self.unpackBinary()
+            if self.cache:
+                self.cache.store(key, self.table)
+
+    def setTable(self, table:np.ndarray)->None:
+        '''
+        Set the decoded arrays. HKData, bins, HGBins and LGBins are views of table.
+
+        Args:
+            table: One row of dtype per record, with the HK values in LPC_HK_NAMES
+                order, and the high gain then low gain bin counts in bin_header order.
+
+        Returns:
+            None
+        '''
+        self.table = table
+        self.bins = table['bins']
+        self.HKData = table['hk'].T
+        self.HGBins = self.bins[:, :16].T
+        self.LGBins = self.bins[:, 16:].T
+
+    def exportArrays(self)->dict:
+        '''
+        Return the decoded arrays, one row per record.
+
+        Returns:
+            dict: The (records, 16) 'hk' and (records, 32) 'bins' arrays.
+        '''
+        return {'hk': self.table['hk'], 'bins': self.bins}
+
+    def to_dataframe(self, arrays:dict=None):
+        '''
+        Build a pandas DataFrame on the decoded arrays, without copying them.
+
+        The columns are the HK channels followed by the bin counts, labelled
+        with LPC_BIN_LABELS. The bin diameters are in bin_header.
+
+        Args:
+            arrays: Arrays as returned by exportArrays(). Defaults to those of this message.
+
+        Returns:
+            pandas.DataFrame: One row per record, indexed by unix_time.
+        '''
+        import pandas as pd
+
+        if arrays is None:
+            arrays = self.exportArrays()
+        hk = arrays['hk']
+        bins = arrays['bins']
+        data = {name: hk[:, i] for i, name in enumerate(LPC_HK_NAMES) if i > 0}
+        data.update({label: bins[:, i] for i, label in enumerate(LPC_BIN_LABELS)})
+        index = pd.Index(hk[:, 0], name='unix_time', copy=False)
+        return pd.DataFrame(data, index=index, copy=False)
+
+    def to_xarray(self, arrays:dict=None):
+        '''
+        Build an xarray Dataset on the decoded arrays, without copying them.
+
+        xarray makes its own copy of the unix_time coordinate for the index.
+
+        Args:
+            arrays: Arrays as returned by exportArrays(). Defaults to those of this message.
+
+        Returns:
+            xarray.Dataset: One variable per HK channel along unix_time, and the
+            bin counts along unix_time and bin. The bin coordinate holds
+            LPC_BIN_LABELS, with the diameter [nm] and gain of each bin
+            as non-index coordinates.
+        '''
+        import xarray as xr
+
+        if arrays is None:
+            arrays = self.exportArrays()
+        hk = arrays['hk']
+        data_vars = {name: ('unix_time', hk[:, i]) for i, name in enumerate(LPC_HK_NAMES) if i > 0}
+        data_vars['counts'] = (('unix_time', 'bin'), arrays['bins'])
+        coords = {'unix_time': hk[:, 0],
+                  'bin': LPC_BIN_LABELS,
+                  'diameter': ('bin', np.array(self.bin_header, dtype=int)),
+                  'gain': ('bin', [label[:2] for label in LPC_BIN_LABELS])}
+        return xr.Dataset(data_vars, coords=coords)
 
     def unpackBinary(self):
-        records = int(len(self.bindata)/96) -2
-        self.HGBins = np.zeros(shape=(16,records))
-        self.LGBins = np.zeros(shape=(16,records))
-        self.HKData = np.zeros(shape=(16,records))
-        for y in range(records):
-          
-            self.HKRaw = []
-           
-            indx = 36 + (y+1)*96
-        
-            for x in range(16):
-                self.HGBins[x,y] = struct.unpack_from('>H',self.bindata,indx + x*2)[0]    
-                self.LGBins[x,y] = struct.unpack_from('>H',self.bindata,indx + x*2 + 32)[0]
-                self.HKRaw.append(struct.unpack_from('>H',self.bindata,indx + x*2 + 64)[0])
-            
+        '''
+        Decode the binary records into the HKData, HGBins and LGBins arrays.
+
+        The HK channels are reordered into LPC_HK_NAMES order, whatever
+        their order in the record layout.
+
+        Returns:
+            None
+        '''
+        raw = decodeRecords(self.bindata, self.layout)
+
+        table = np.empty(len(raw), dtype=self.dtype)
+        table['hk'] = convertFields(raw, self.layout, LPC_HK_NAMES)
+        # elapsed time since the start of the measurement in seconds
+        table['hk'][:, 0] += self.unix_end_time
+        table['bins'] = rfn.structured_to_unstructured(raw[['HGBins', 'LGBins']], dtype=float)
+        self.setTable(table)
 
-            #modified to agree with the current LPC HK scheme - this will need to be updated for mission 
-            self.HKData[0,y] = self.HKRaw[0] + self.unix_end_time #elapsed time since the start of the measurement in seconds
-            self.HKData[1,y] = self.HKRaw[1]  # Pump1 Current in mA
-            self.HKData[2,y] = self.HKRaw[2]  # Pump2 Current in mA
-            self.HKData[3,y] = self.HKRaw[3]  # Detector Current in mA
-            
-            self.HKData[4,y] = self.HKRaw[4] / 1000.0 # Detector voltage in V
-            self.HKData[5,y] = self.HKRaw[5] / 1000.0 # PHA Voltage in volts
-            self.HKData[6,y] = self.HKRaw[6] / 1000.0 # Tennsy V in volts
-            self.HKData[7,y] = self.HKRaw[7] / 1000.0 # VBattery V 
-            self.HKData[8,y] = self.HKRaw[8] / 1000.0 # Flow in LPM
-            self.HKData[9,y] = self.HKRaw[9] # Pump1 PWM drive signal (0 - 1023)
-            self.HKData[10,y] = self.HKRaw[10] # Pump2 PWM drive signal (0 - 1023)
-            self.HKData[11,y] = self.HKRaw[11] / 100.0 - 273.15 # Pump1 T in C
-            self.HKData[12,y] = self.HKRaw[12] / 100.0 - 273.15 # Pump2 T in C
-            self.HKData[13,y] = self.HKRaw[13] / 100.0 - 273.15 # Laser T in C
-            self.HKData[14,y] = self.HKRaw[14] / 100.0 - 273.15 # Board T in C
-            self.HKData[15,y] = self.HKRaw[15] / 100.0 - 273.15 # Inlet T in C
     def csvText(self)->list:
         '''
         Generate CSV text lines from the records.
@@ -366,11 +950,10 @@ class LPCmsg(TMmsg):
                    'Altitude [m]:',self.alt]
         csv_writer.writerow(header2)
 
-        header3 = ['Time', 'Pump1_I','Pump2_I','PHA_I', 'PHA_12V','PHA_3V3','CPU_V', 'Input_V', 'Flow', 
-                   'Pump1_PWM', 'Pump2_PWM','Pump1_T', 'Pump2_T', 'Laser_T', 'PCB_T', 'Inlet_T'] + bin_header
+        header3 = LPC_HK_NAMES + bin_header
         csv_writer.writerow(header3)
 
-        header4 = ['[unix_time]', '[mA]','[mA]','[mA]','[V]','[V]','[V]', '[V]', '[SLPM]','[#]','[#]', '[C]', '[C]','[C]', '[C]', '[C]'] + ['[diam >nm]']*len(bin_header)
+        header4 = LPC_HK_UNITS + ['[diam >nm]']*len(bin_header)
         csv_writer.writerow(header4)
 
         for row in range(len(self.HKData[0,:])):
@@ -397,6 +980,204 @@ class LPCmsg(TMmsg):
                 out_file.write(r)
                 out_file.write('\n')
 
+def concatArrays(msgs:list)->dict:
+    '''
+    Concatenate the decoded arrays of several messages.
+
+    Each output array is allocated once, for all of the messages.
+
+    Args:
+        msgs: RS41msg or LPCmsg objects, all of the same type.
+
+    Returns:
+        dict: Arrays in the exportArrays() format.
+
+    Raises:
+        ValueError: If msgs is empty.
+        TypeError: If the messages are not all of the same type.
+    '''
+    if not msgs:
+        raise ValueError('No messages to concatenate')
+    if len(set(type(m) for m in msgs)) != 1:
+        raise TypeError('Messages must all be of the same type')
+
+    arrays = [m.exportArrays() for m in msgs]
+    return {name: np.concatenate([a[name] for a in arrays]) for name in arrays[0]}
+
+def concat_dataframe(msgs:list):
+    '''
+    Build one pandas DataFrame from several messages of the same type.
+
+    Args:
+        msgs: RS41msg or LPCmsg objects, all of the same type.
+
+    Returns:
+        pandas.DataFrame: As from to_dataframe(), with the rows of all messages.
+    '''
+    arrays = concatArrays(msgs)
+    return msgs[0].to_dataframe(arrays)
+
+def concat_xarray(msgs:list):
+    '''
+    Build one xarray Dataset from several messages of the same type.
+
+    Args:
+        msgs: RS41msg or LPCmsg objects, all of the same type.
+
+    Returns:
+        xarray.Dataset: As from to_xarray(), with the records of all messages.
+    '''
+    arrays = concatArrays(msgs)
+    return msgs[0].to_xarray(arrays)
+
+def sortedArrays(t:np.ndarray, arrays:dict)->tuple:
+    '''
+    Sort arrays by time, if they are not already.
+
+    Args:
+        t: The time of each row.
+        arrays: Arrays with one row per time.
+
+    Returns:
+        tuple: The sorted times and arrays.
+    '''
+    if np.all(t[1:] >= t[:-1]):
+        return t, arrays
+    order = np.argsort(t, kind='stable')
+    return t[order], {name: a[order] for name, a in arrays.items()}
+
+def resample(t:np.ndarray, arrays:dict, grid:np.ndarray, method:str='nearest', max_gap:float=None)->dict:
+    '''
+    Resample arrays onto a time grid.
+
+    The source rows for each grid time are found with a binary search of
+    the sorted times, and are then applied to all of the arrays at once.
+    Integer arrays, such as flags and error codes, are always resampled
+    with 'nearest'.
+
+    Args:
+        t: The sorted time of each row.
+        arrays: Arrays with one row per time.
+        grid: The times to resample to.
+        method: 'nearest' or 'linear'.
+        max_gap: For 'nearest', grid times further than this from the nearest row
+            are set to NaN. For 'linear', grid times between rows further apart than
+            this are set to NaN. No limit if None.
+
+    Returns:
+        dict: Float arrays with one row per grid time.
+
+    Raises:
+        ValueError: If method is not known.
+    '''
+    if method not in ('nearest', 'linear'):
+        raise ValueError(f'Unknown resampling method {method}')
+    if max_gap is None:
+        max_gap = np.inf
+
+    out = {}
+    if len(t) == 0:
+        for name, a in arrays.items():
+            out[name] = np.full((len(grid),) + a.shape[1:], np.nan)
+        return out
+
+    right = np.clip(np.searchsorted(t, grid), 1, len(t)-1) if len(t) > 1 else np.zeros(len(grid), dtype=int)
+    left = np.maximum(right - 1, 0)
+    dl = np.abs(grid - t[left])
+    dr = np.abs(t[right] - grid)
+
+    nearest = np.where(dr < dl, right, left)
+    if method == 'nearest':
+        missing = np.minimum(dl, dr) > max_gap
+    else:
+        span = t[right] - t[left]
+        w = np.divide(grid - t[left], span, out=np.zeros(len(grid)), where=span > 0)
+        exact = np.minimum(dl, dr) == 0
+        missing = (grid < t[0]) | (grid > t[-1]) | ((span > max_gap) & ~exact)
+
+    for name, a in arrays.items():
+        if method == 'nearest' or np.issubdtype(a.dtype, np.integer):
+            v = a[nearest].astype(float)
+        else:
+            wa = w.reshape((-1,) + (1,)*(a.ndim-1))
+            v = a[left]*(1-wa) + a[right]*wa
+        v[missing] = np.nan
+        out[name] = v
+
+    return out
+
+def defaultGap(t:np.ndarray)->float:
+    '''
+    Return twice the median interval of sorted times, or 0 for fewer than two times.
+    '''
+    if len(t) < 2:
+        return 0.0
+    return 2*float(np.median(np.diff(t)))
+
+def alignArrays(rs41_msgs:list, lpc_msgs:list, step:float=1.0, start:float=None, end:float=None,
+                method:str='nearest', max_gap:float=None)->tuple:
+    '''
+    Resample RS41 and LPC messages onto a common time grid.
+
+    Args:
+        rs41_msgs: RS41msg objects.
+        lpc_msgs: LPCmsg objects.
+        step: The grid spacing in seconds.
+        start: The first grid time. Defaults to the start of the time range covered by both instruments.
+        end: The last grid time. Defaults to the end of the time range covered by both instruments.
+        method: 'nearest' or 'linear'.
+        max_gap: Passed to resample(). Defaults to twice the median sample interval
+            of each instrument, so that gaps between measurements are left as NaN.
+
+    Returns:
+        tuple: The RS41 and LPC arrays in the exportArrays() format, on the grid.
+
+    Raises:
+        ValueError: If step is not positive.
+    '''
+    if step <= 0:
+        raise ValueError(f'The grid step must be positive, not {step}')
+
+    rs41 = concatArrays(rs41_msgs)
+    rs41_t, rs41 = sortedArrays(rs41['unix_time'], rs41)
+    lpc = concatArrays(lpc_msgs)
+    lpc_t, lpc = sortedArrays(lpc['hk'][:, 0], lpc)
+
+    if start is None:
+        start = max(rs41_t[0], lpc_t[0])
+    if end is None:
+        end = min(rs41_t[-1], lpc_t[-1])
+    n = max(int(np.floor((end - start) / step)) + 1, 0)
+    grid = start + step*np.arange(n)
+
+    rs41 = resample(rs41_t, rs41, grid, method, defaultGap(rs41_t) if max_gap is None else max_gap)
+    rs41['unix_time'] = grid
+    lpc = resample(lpc_t, lpc, grid, method, defaultGap(lpc_t) if max_gap is None else max_gap)
+    lpc['hk'][:, 0] = grid
+
+    return rs41, lpc
+
+def align_dataframe(rs41_msgs:list, lpc_msgs:list, **kwargs):
+    '''
+    Build one pandas DataFrame of RS41 and LPC data on a common time grid.
+
+    Args:
+        rs41_msgs: RS41msg objects.
+        lpc_msgs: LPCmsg objects.
+        kwargs: Passed to alignArrays().
+
+    Returns:
+        pandas.DataFrame: The RS41 columns followed by the LPC columns, indexed by unix_time.
+
+    Examples:
+        df = align_dataframe(rs41_msgs, lpc_msgs, step=10, method='linear')
+        df[['air_temp_degC', 'wv_mixing_ratio_ppmv', 'HG01', 'HG07']]
+    '''
+    import pandas as pd
+
+    rs41, lpc = alignArrays(rs41_msgs, lpc_msgs, **kwargs)
+    return pd.concat([rs41_msgs[0].to_dataframe(rs41), lpc_msgs[0].to_dataframe(lpc)], axis=1)
+
 def argParse():
     '''
     Parse command line arguments for the TMdecoder script.
@@ -420,6 +1201,8 @@ def argParse():
     parser.add_argument('-b', '--batch', action='store_true', help='Batch process, creating .csv files')
     parser.add_argument('-t', '--tm', action='store_true', help='Print the TM header')
     parser.add_argument('-q', '--quiet',  action='store_true', help='Turn off printing')  # on/off flag
+    parser.add_argument('-k', '--cache', help='Cache decoded data in this directory')
+    parser.add_argument('--cache-size', type=int, default=1024, help='Maximum cache size in MB (default 1024)')
 
     args=parser.parse_args()
 
@@ -468,6 +1251,10 @@ if __name__ == "__main__":
         tm_files = [args.filename_or_ext]
         csv_files = [args.csv]
 
+    cache = None
+    if args.cache:
+        cache = TMcache(args.cache, args.cache_size*1024*1024)
+
     for tm_file, csv_file in zip(tm_files, csv_files):
 
         try:
@@ -477,9 +1264,9 @@ if __name__ == "__main__":
                 msg_type = determine_msg_type(tm_file)
 
             if msg_type == 'lpc':
-                msg = LPCmsg(tm_file)
+                msg = LPCmsg(tm_file, cache)
             if msg_type == 'rs41':
-                msg = RS41msg(tm_file)
+                msg = RS41msg(tm_file, cache)
 
             if args.tm:
                 print(msg.tm())
@@ -489,5 +1276,5 @@ if __name__ == "__main__":
 
             if csv_file:
                 msg.saveCsv(csv_file)
-        except struct.error:
+        except (struct.error, ValueError, IndexError):
             print(f'*** Error decoding binary data in {tm_file}, file was not processed')
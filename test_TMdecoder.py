@@ -0,0 +1,401 @@
+import os
+
+import numpy as np
+import pytest
+
+import TMdecoder as T
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+RS41_TM = os.path.join(HERE, 'TM.RS41.ready_tm')
+LPC_TM = os.path.join(HERE, 'TM.LPC.ready_tm')
+
+
+def cacheSize(cache_dir):
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(cache_dir) for f in files)
+
+
+def storeOne(cache_dir, key):
+    cache = T.TMcache(str(cache_dir))
+    cache.store(key, np.zeros(1000))
+    return cache.cache_dir
+
+
+def entryKeys(cache):
+    return sorted(f[:-4] for f in os.listdir(cache.cache_dir) if f.endswith('.npy'))
+
+
+def test_cache_hit_rs41(tmp_path):
+    fresh = T.RS41msg(RS41_TM)
+    cache = T.TMcache(str(tmp_path))
+    T.RS41msg(RS41_TM, cache)
+    cached = T.RS41msg(RS41_TM, cache)
+
+    for f in T.RS41msg.fields:
+        assert isinstance(cached.columns[f], np.memmap)
+        assert np.shares_memory(cached.columns[f], cached.table)
+        np.testing.assert_array_equal(cached.columns[f], fresh.columns[f])
+    assert cached.records == fresh.records
+    # One file per entry
+    assert len(os.listdir(str(tmp_path))) == 1
+
+
+def test_cache_hit_lpc(tmp_path):
+    fresh = T.LPCmsg(LPC_TM)
+    cache = T.TMcache(str(tmp_path))
+    T.LPCmsg(LPC_TM, cache)
+    cached = T.LPCmsg(LPC_TM, cache)
+
+    assert isinstance(cached.bins, np.memmap)
+    assert np.shares_memory(cached.HKData, cached.table)
+    np.testing.assert_array_equal(cached.HKData, fresh.HKData)
+    np.testing.assert_array_equal(cached.HGBins, fresh.HGBins)
+    np.testing.assert_array_equal(cached.LGBins, fresh.LGBins)
+    assert cached.csvText() == fresh.csvText()
+
+
+def test_cache_key_depends_on_msg_type(tmp_path):
+    cache = T.TMcache(str(tmp_path))
+    T.RS41msg(RS41_TM, cache)
+    # Decoding the same file as the other type must not load the RS41 entry
+    msg = T.LPCmsg(RS41_TM, cache)
+    assert msg.HKData.shape[0] == 16
+
+
+@pytest.mark.parametrize('keep', [0, 20, 200])
+def test_cache_rewrites_bad_entry(tmp_path, keep):
+    cache = T.TMcache(str(tmp_path))
+    T.LPCmsg(LPC_TM, cache)
+    key = entryKeys(cache)[0]
+    path = cache.entryPath(key)
+    # Truncate the entry
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:keep])
+
+    assert cache.load(key, T.LPCmsg.dtype) is None
+    assert not os.path.exists(path)
+    msg = T.LPCmsg(LPC_TM, cache)
+    assert msg.bins.shape == (msg.HKData.shape[1], 32)
+    assert cache.load(key, T.LPCmsg.dtype) is not None
+
+
+def test_cache_wrong_dtype_is_miss(tmp_path):
+    cache = T.TMcache(str(tmp_path))
+    cache.store('k', np.zeros(10, dtype=T.LPCmsg.dtype))
+    assert cache.load('k', T.RS41msg.dtype) is None
+    assert cache.load('missing', T.RS41msg.dtype) is None
+
+
+def test_cache_read_only(tmp_path, monkeypatch):
+    cache = T.TMcache(str(tmp_path))
+    T.RS41msg(RS41_TM, cache)
+    key = entryKeys(cache)[0]
+
+    def utime(*args):
+        raise PermissionError('read-only cache')
+
+    # A hit must not depend on updating the access time, nor delete the entry
+    monkeypatch.setattr(os, 'utime', utime)
+    assert cache.load(key, T.RS41msg.dtype) is not None
+    assert cache.load(key, T.RS41msg.dtype) is not None
+
+
+def test_cache_eviction(tmp_path):
+    entry_bytes = cacheSize(storeOne(tmp_path / 'probe', 'probe'))
+    cache = T.TMcache(str(tmp_path / 'cache'), max_bytes=3*entry_bytes)
+
+    for i in range(6):
+        cache.store(f'k{i}', np.full(1000, i, dtype=float))
+        # Distinct access times for the LRU order
+        os.utime(cache.entryPath(f'k{i}'), (i, i))
+        assert cacheSize(cache.cache_dir) <= cache.max_bytes
+        assert cache.total_bytes == cacheSize(cache.cache_dir)
+
+    # Eviction goes down to low_water * max_bytes, leaving two entries
+    assert entryKeys(cache) == ['k4', 'k5']
+
+
+def test_cache_eviction_keeps_recently_used(tmp_path):
+    entry_bytes = cacheSize(storeOne(tmp_path / 'probe', 'probe'))
+    cache = T.TMcache(str(tmp_path / 'cache'), max_bytes=3*entry_bytes)
+
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.store(key, np.zeros(1000))
+        os.utime(cache.entryPath(key), (i, i))
+    # Loading 'a' makes it the most recently used
+    assert cache.load('a', np.zeros(0).dtype) is not None
+    cache.store('d', np.zeros(1000))
+
+    assert entryKeys(cache) == ['a', 'd']
+
+
+def lpc2021File(tmp_path):
+    '''Rewrite the LPC sample TM with its HK channels in the 2021 order.'''
+    with open(LPC_TM, 'rb') as f:
+        data = bytearray(f.read())
+    bin_start = data.find(b'</CRC>\nSTART') + 12
+    layout = T.LAYOUTS['lpc_2023']
+    order_2023 = [f[0] for f in layout['fields'][2:]]
+    order_2021 = [f[0] for f in T.LAYOUTS['lpc_2021']['fields'][2:]]
+
+    msg = T.LPCmsg(LPC_TM)
+    for r in range(msg.HKData.shape[1]):
+        hk = bin_start + layout['header_len'] + r*96 + 64
+        raw = {name: data[hk + 2*i:hk + 2*i + 2] for i, name in enumerate(order_2023)}
+        data[hk:hk + 32] = b''.join(raw[name] for name in order_2021)
+
+    path = str(tmp_path / 'TM.LPC2021.ready_tm')
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_lpc_layouts_same_hk_order(tmp_path):
+    current = T.LPCmsg(LPC_TM, layout='lpc_2023')
+    old = T.LPCmsg(lpc2021File(tmp_path), layout='lpc_2021')
+
+    assert T.LAYOUTS['lpc_2021']['fields'] != T.LAYOUTS['lpc_2023']['fields']
+    np.testing.assert_array_equal(old.HKData, current.HKData)
+    np.testing.assert_array_equal(old.bins, current.bins)
+
+
+def test_lpc_layout_reorders_hk():
+    current = T.LPCmsg(LPC_TM, layout='lpc_2023')
+    old = T.LPCmsg(LPC_TM, layout='lpc_2021')
+    # The 2021 layout stores Input_V, Flow, CPU_V where the current one stores CPU_V, Input_V, Flow
+    np.testing.assert_array_equal(old.HKData[6:9], current.HKData[[8, 6, 7]])
+
+
+def test_select_layout():
+    assert T.selectLayout('rs41', 1719238029) == 'rs41'
+    assert T.selectLayout('lpc', 1640000000) == 'lpc_2021'
+    assert T.selectLayout('lpc', 1719238029) == 'lpc_2023'
+    assert T.LPCmsg(LPC_TM).layout == 'lpc_2023'
+    with pytest.raises(KeyError):
+        T.selectLayout('unknown', 1719238029)
+
+
+def test_record_count():
+    rs41 = T.RS41msg(RS41_TM)
+    assert len(rs41.records) == 300
+    lpc = T.LPCmsg(LPC_TM)
+    assert lpc.HKData.shape == (16, 78)
+    # A partial record is not decoded
+    assert T.recordCount(rs41.bindata[:-1], 'rs41') == 299
+
+
+def test_resample_edges():
+    t = np.array([0., 1., 2.])
+    a = {'x': np.array([0., 10., 20.])}
+    grid = np.array([-0.5, 0., 2., 2.5, 5.])
+
+    nearest = T.resample(t, a, grid, 'nearest', max_gap=1)['x']
+    np.testing.assert_array_equal(nearest, [0., 0., 20., 20., np.nan])
+    # No extrapolation
+    linear = T.resample(t, a, grid, 'linear', max_gap=1)['x']
+    np.testing.assert_array_equal(linear, [np.nan, 0., 20., np.nan, np.nan])
+
+
+def test_resample_gaps():
+    t = np.array([0., 1., 2., 10., 11.])
+    a = {'x': np.array([0., 10., 20., 100., 110.])}
+    grid = np.array([1.5, 3., 6., 10., 10.5])
+
+    nearest = T.resample(t, a, grid, 'nearest', max_gap=1)['x']
+    np.testing.assert_array_equal(nearest, [10., 20., np.nan, 100., 100.])
+    linear = T.resample(t, a, grid, 'linear', max_gap=1)['x']
+    np.testing.assert_array_equal(linear, [15., np.nan, np.nan, 100., 105.])
+    # Without a limit the gap is interpolated across
+    linear = T.resample(t, a, grid, 'linear')['x']
+    np.testing.assert_allclose(linear, [15., 30., 60., 100., 105.])
+
+
+def test_resample_single_sample():
+    t = np.array([5.])
+    a = {'x': np.array([1.]), 'y': np.array([[1., 2.]])}
+    grid = np.array([4., 5., 6.])
+
+    out = T.resample(t, a, grid, 'nearest', max_gap=1)
+    np.testing.assert_array_equal(out['x'], [1., 1., 1.])
+    assert out['y'].shape == (3, 2)
+    out = T.resample(t, a, grid, 'linear', max_gap=1)
+    np.testing.assert_array_equal(out['x'], [np.nan, 1., np.nan])
+
+    out = T.resample(np.array([]), {'x': np.array([])}, grid, 'linear')
+    assert np.all(np.isnan(out['x']))
+
+
+def test_resample_ties():
+    # Halfway between two rows, nearest takes the earlier one
+    t = np.array([0., 2.])
+    a = {'x': np.array([0., 20.])}
+    np.testing.assert_array_equal(T.resample(t, a, np.array([1.]), 'nearest')['x'], [0.])
+
+    # Repeated times do not divide by zero
+    t = np.array([0., 1., 1., 2.])
+    a = {'x': np.array([0., 10., 12., 20.])}
+    out = T.resample(t, a, np.array([0.5, 1., 1.5]), 'linear')['x']
+    assert np.all(np.isfinite(out))
+    assert out[1] in (10., 12.)
+
+
+def test_resample_integer_columns_nearest():
+    t = np.array([0., 1., 2.])
+    a = {'valid': np.array([1, 0, 1]), 'x': np.array([0., 10., 20.])}
+    out = T.resample(t, a, np.array([0.4, 0.6, 1.5]), 'linear')
+    np.testing.assert_array_equal(out['valid'], [1., 0., 0.])
+    np.testing.assert_allclose(out['x'], [4., 6., 15.])
+
+
+def test_resample_unknown_method():
+    with pytest.raises(ValueError):
+        T.resample(np.array([0.]), {}, np.array([0.]), 'cubic')
+
+
+def test_align_arrays():
+    rs41 = T.RS41msg(RS41_TM)
+    lpc = T.LPCmsg(LPC_TM)
+    rs41_grid, lpc_grid = T.alignArrays([rs41], [lpc], step=2, method='linear')
+
+    grid = rs41_grid['unix_time']
+    np.testing.assert_array_equal(grid, lpc_grid['hk'][:, 0])
+    assert np.all(np.diff(grid) == 2)
+    assert grid[0] == max(rs41.columns['unix_time'][0], lpc.HKData[0, 0])
+    assert lpc_grid['bins'].shape == (len(grid), 32)
+    assert set(np.unique(rs41_grid['valid'])) <= {0., 1.}
+
+
+@pytest.mark.parametrize('step', [0, -1])
+def test_align_arrays_bad_step(step):
+    with pytest.raises(ValueError):
+        T.alignArrays([T.RS41msg(RS41_TM)], [T.LPCmsg(LPC_TM)], step=step)
+
+
+@pytest.fixture(params=['fresh', 'cached'])
+def msgs(request, tmp_path):
+    '''An RS41 and an LPC message, decoded or loaded from the cache.'''
+    cache = None
+    if request.param == 'cached':
+        cache = T.TMcache(str(tmp_path))
+        T.RS41msg(RS41_TM, cache)
+        T.LPCmsg(LPC_TM, cache)
+    rs41 = T.RS41msg(RS41_TM, cache)
+    lpc = T.LPCmsg(LPC_TM, cache)
+    assert isinstance(lpc.bins, np.memmap) == (cache is not None)
+    return rs41, lpc
+
+
+def test_rs41_to_dataframe(msgs):
+    pytest.importorskip('pandas')
+    rs41, _ = msgs
+    df = rs41.to_dataframe()
+
+    assert df.index.name == 'unix_time'
+    assert np.shares_memory(df.index.to_numpy(), rs41.columns['unix_time'])
+    assert list(df.columns) == [f for f in T.RS41msg.fields if f != 'unix_time']
+    for f in df.columns:
+        assert np.shares_memory(df[f].to_numpy(), rs41.columns[f])
+
+
+def test_lpc_to_dataframe(msgs):
+    pytest.importorskip('pandas')
+    _, lpc = msgs
+    df = lpc.to_dataframe()
+
+    assert df.index.name == 'unix_time'
+    np.testing.assert_array_equal(df.index.to_numpy(), lpc.HKData[0])
+    assert np.shares_memory(df.index.to_numpy(), lpc.HKData)
+    assert list(df.columns) == T.LPC_HK_NAMES[1:] + T.LPC_BIN_LABELS
+    assert np.shares_memory(df['Flow'].to_numpy(), lpc.HKData)
+    assert np.shares_memory(df['LG15'].to_numpy(), lpc.bins)
+    np.testing.assert_array_equal(df['HG00'].to_numpy(), lpc.HGBins[0])
+
+
+def test_rs41_to_xarray(msgs):
+    pytest.importorskip('xarray')
+    rs41, _ = msgs
+    ds = rs41.to_xarray()
+
+    assert 'unix_time' in ds.indexes
+    np.testing.assert_array_equal(ds['unix_time'].values, rs41.columns['unix_time'])
+    assert np.shares_memory(ds['pres_mb'].values, rs41.columns['pres_mb'])
+
+
+def test_lpc_to_xarray(msgs):
+    pytest.importorskip('xarray')
+    _, lpc = msgs
+    ds = lpc.to_xarray()
+
+    assert 'unix_time' in ds.indexes
+    np.testing.assert_array_equal(ds['unix_time'].values, lpc.HKData[0])
+    assert np.shares_memory(ds['counts'].values, lpc.bins)
+    assert np.shares_memory(ds['Flow'].values, lpc.HKData)
+    assert list(ds['bin'].values) == T.LPC_BIN_LABELS
+    assert list(ds['diameter'].values) == [int(d) for d in lpc.bin_header]
+    assert list(ds['gain'].values) == ['HG']*16 + ['LG']*16
+    np.testing.assert_array_equal(ds['counts'].sel(bin='LG03').values, lpc.LGBins[3])
+
+
+def test_frames_are_writable(msgs):
+    pytest.importorskip('pandas')
+    pytest.importorskip('xarray')
+    rs41, lpc = msgs
+    flow = lpc.HKData[8].copy()
+
+    df = lpc.to_dataframe()
+    df['Flow'] *= 2
+    np.testing.assert_array_equal(df['Flow'].to_numpy(), flow*2)
+    ds = rs41.to_xarray()
+    ds['pres_mb'] *= 2
+    lpc.bins[0, 0] = -1
+
+
+def test_cached_data_not_changed_by_writes(tmp_path):
+    cache = T.TMcache(str(tmp_path))
+    T.LPCmsg(LPC_TM, cache)
+    lpc = T.LPCmsg(LPC_TM, cache)
+    flow = lpc.HKData[8].copy()
+    lpc.HKData[8] *= 2
+
+    np.testing.assert_array_equal(T.LPCmsg(LPC_TM, cache).HKData[8], flow)
+
+
+def test_concat(msgs):
+    pytest.importorskip('pandas')
+    pytest.importorskip('xarray')
+    rs41, lpc = msgs
+
+    df = T.concat_dataframe([lpc, lpc, lpc])
+    assert len(df) == 3*lpc.HKData.shape[1]
+    assert list(df.columns) == list(lpc.to_dataframe().columns)
+    df = T.concat_dataframe([rs41, rs41])
+    assert len(df) == 2*len(rs41.columns['unix_time'])
+
+    ds = T.concat_xarray([lpc, lpc])
+    assert ds.sizes['unix_time'] == 2*lpc.HKData.shape[1]
+    assert ds.sizes['bin'] == 32
+    ds = T.concat_xarray([rs41, rs41, rs41])
+    assert ds.sizes['unix_time'] == 3*len(rs41.columns['unix_time'])
+
+    with pytest.raises(TypeError):
+        T.concat_dataframe([rs41, lpc])
+    with pytest.raises(ValueError):
+        T.concat_xarray([])
+
+
+def test_align_dataframe(msgs):
+    pytest.importorskip('pandas')
+    rs41, lpc = msgs
+    df = T.align_dataframe([rs41], [lpc], step=2)
+
+    assert df.index.name == 'unix_time'
+    assert np.all(np.diff(df.index.to_numpy()) == 2)
+    assert list(df.columns) == (list(rs41.to_dataframe().columns) + list(lpc.to_dataframe().columns))
+
+
+def test_lpc_csv_header_matches_hk_order():
+    lines = T.LPCmsg(LPC_TM).csvText()
+    assert lines[2].split(',')[:16] == T.LPC_HK_NAMES
+    assert len(lines[3].split(',')) == 16 + 32